@@ -1,14 +1,24 @@
 #!/usr/bin/env python3
 import argparse
-import json
+import functools
 import os
 import pathlib
 import shlex
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
+import httpx
+import orjson
 import yaml
 
+from fleet_http import PRINT_LOCK, send_request
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+    print("⚠️  PyYAML was installed without libyaml; falling back to its much slower pure-Python parser.", file=sys.stderr)
+
 # --- API Helper Functions ---
 def get_api_key() -> str:
     api_key = os.getenv("ELASTIC_API_KEY")
@@ -16,63 +26,130 @@ def get_api_key() -> str:
         sys.exit("❌ ELASTIC_API_KEY environment variable is not set.")
     return api_key
 
-def make_api_request(method: str, url: str, api_key: str, dry_run: bool = False, **kwargs) -> requests.Response | None:
+def print_dry_run_request(method: str, url: str, json: dict | None = None) -> None:
+    """Prints the request that would be made, with a CURL equivalent for any body."""
+    print(f"      DRY RUN: Would execute {method.upper()} {url}")
+    if json:
+        # Clean up for printing, remove purely informational fields
+        body_to_print = {k: v for k, v in json.items() if not k.startswith('_')}
+        curl_command = (
+            f"curl -X {method.upper()} \\\n"
+            f"  -H \"Authorization: ApiKey $ELASTIC_API_KEY\" \\\n"
+            f"  -H \"kbn-xsrf: true\" \\\n"
+            f"  -H \"Content-Type: application/json\" \\\n"
+            f"  \"{url}\" \\\n"
+            f"  -d {shlex.quote(orjson.dumps(body_to_print, option=orjson.OPT_INDENT_2).decode())}"
+        )
+        print("      CURL equivalent:")
+        print(curl_command)
+
+def make_sender(api_key: str):
+    """
+    Returns a send(method, url, json=None) function that executes requests for
+    real, exiting on any API error. Headers are built once, not per request.
+    """
     headers = {"Authorization": f"ApiKey {api_key}", "kbn-xsrf": "true", "Content-Type": "application/json"}
-    
-    if dry_run:
-        print(f"      DRY RUN: Would execute {method.upper()} {url}")
-        json_body = kwargs.get("json")
-        if json_body:
-            # Clean up for printing, remove purely informational fields
-            body_to_print = {k: v for k, v in json_body.items() if not k.startswith('_')}
-            curl_command = (
-                f"curl -X {method.upper()} \\\n"
-                f"  -H \"Authorization: ApiKey $ELASTIC_API_KEY\" \\\n"
-                f"  -H \"kbn-xsrf: true\" \\\n"
-                f"  -H \"Content-Type: application/json\" \\\n"
-                f"  \"{url}\" \\\n"
-                f"  -d {shlex.quote(json.dumps(body_to_print, indent=2))}"
-            )
-            print("      CURL equivalent:")
-            print(curl_command)
-        return None
 
+    def send(method: str, url: str, json: dict | None = None) -> httpx.Response:
+        content = orjson.dumps(json) if json is not None else None
+        try:
+            response = send_request(method, url, headers=headers, content=content)
+            response.raise_for_status()
+            return response
+        except httpx.HTTPError as exc:
+            with PRINT_LOCK:
+                print(f"❌ API Error: {method.upper()} {url} failed: {exc}")
+                if isinstance(exc, httpx.HTTPStatusError):
+                    print(f"   Response: {exc.response.text}")
+            sys.exit(1)
+
+    return send
+
+def send_concurrently(pending: list, send, max_workers: int = 8) -> None:
+    """
+    Sends a batch of independent (method, url, json_body, done_message) requests
+    in parallel with send() over the shared client, printing done_message (if any) as each
+    one succeeds. Every request runs to completion before the first failure is
+    re-raised, so no error is lost.
+    """
+    if not pending:
+        return
+
+    def send_and_report(method: str, url: str, body: dict, done_message: str | None) -> None:
+        send(method, url, json=body)
+        if done_message:
+            with PRINT_LOCK:
+                print(done_message)
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(send_and_report, *request) for request in pending]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (Exception, SystemExit) as exc:
+                errors.append(exc)
+    if errors:
+        raise errors[0]
+
+@functools.lru_cache(maxsize=512)
+def parse_json_file(path: str, mtime_ns: int, size: int) -> dict:
+    """Parses a JSON file; mtime_ns and size are only part of the cache key."""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+def load_json_file(path: pathlib.Path) -> dict | None:
+    """
+    Loads a state JSON file, or returns None if it does not exist. The single
+    stat doubles as the existence check and the cache key, so fragments shared
+    by many policies are read and decoded only once while unchanged. The result
+    is shared and must not be mutated.
+    """
     try:
-        response = requests.request(method, url, headers=headers, timeout=30, **kwargs)
-        response.raise_for_status()
-        return response
-    except requests.exceptions.RequestException as exc:
-        print(f"❌ API Error: {method.upper()} {url} failed: {exc}")
-        if exc.response is not None:
-            print(f"   Response: {exc.response.text}")
-        sys.exit(1)
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return parse_json_file(str(path), stat.st_mtime_ns, stat.st_size)
 
 # --- Build Functions ---
 def apply_foundational_assets(es_url: str, api_key: str, state_dir: pathlib.Path, assets_config: dict, dry_run: bool):
     print("🏗️  Applying foundational assets...")
+    send = make_sender(api_key)
+    # Each asset type is sent as one parallel batch. The batches stay serial so
+    # later asset types can rely on the ones applied before them.
     # Apply component templates
     templates_dir = state_dir / "component_templates"
+    pending = []
     for template_name in assets_config.get("component_templates", []):
         path = templates_dir / f"{template_name}.json"
-        if not path.exists():
+        template_body = load_json_file(path)
+        if template_body is None:
             print(f"   ⚠️  Warning: Component template file not found, skipping: {path}")
             continue
         print(f"   -> Planning to apply component template: {template_name}")
-        with open(path, 'r') as f:
-            template_body = json.load(f)
-        make_api_request("PUT", f"{es_url}/_component_template/{template_name}", api_key, json=template_body, dry_run=dry_run)
+        url = f"{es_url}/_component_template/{template_name}"
+        if dry_run:
+            print_dry_run_request("PUT", url, json=template_body)
+        else:
+            pending.append(("PUT", url, template_body, None))
+    send_concurrently(pending, send)
 
     # Apply ingest pipelines
     pipelines_dir = state_dir / "pipelines"
+    pending = []
     for pipeline_name in assets_config.get("ingest_pipelines", []):
         path = pipelines_dir / f"{pipeline_name}.json"
-        if not path.exists():
+        pipeline_body = load_json_file(path)
+        if pipeline_body is None:
             print(f"   ⚠️  Warning: Ingest pipeline file not found, skipping: {path}")
             continue
         print(f"   -> Planning to apply ingest pipeline: {pipeline_name}")
-        with open(path, 'r') as f:
-            pipeline_body = json.load(f)
-        make_api_request("PUT", f"{es_url}/_ingest/pipeline/{pipeline_name}", api_key, json=pipeline_body, dry_run=dry_run)
+        url = f"{es_url}/_ingest/pipeline/{pipeline_name}"
+        if dry_run:
+            print_dry_run_request("PUT", url, json=pipeline_body)
+        else:
+            pending.append(("PUT", url, pipeline_body, None))
+    send_concurrently(pending, send)
     
     if not dry_run:
         print("   ✅ Foundational assets applied.")
@@ -80,6 +157,7 @@ def apply_foundational_assets(es_url: str, api_key: str, state_dir: pathlib.Path
 def generate_and_apply_agent_policies(kibana_url: str, api_key: str, config: dict, state_dir: pathlib.Path, dry_run: bool):
     """Generates and idempotently applies agent policies from the agent_policies block."""
     print("\n📜 Generating and applying agent policies...")
+    send = make_sender(api_key)
 
     policies_config = config.get("agent_policies", {})
     definitions = config.get("integration_definitions", {})
@@ -98,14 +176,15 @@ def generate_and_apply_agent_policies(kibana_url: str, api_key: str, config: dic
     get_policies_url = f"{kibana_url}/api/fleet/agent_policies?perPage=5000"
     # For GET requests, we don't want to dry-run, we need the data to plan.
     try:
-        existing_policies_resp = make_api_request("GET", get_policies_url, api_key, dry_run=False) 
-        if existing_policies_resp:
-            policy_name_to_id = {p["name"]: p["id"] for p in existing_policies_resp.json().get("items", [])}
+        existing_policies_resp = send("GET", get_policies_url)
+        policy_name_to_id = {p["name"]: p["id"] for p in orjson.loads(existing_policies_resp.content).get("items", [])}
     except SystemExit:
         if not dry_run: sys.exit(f"   -> CRITICAL: Could not fetch existing policies from {get_policies_url}. Exiting.")
         print("   -> WARNING: Could not fetch existing policies. Assuming all policies are new for this dry run.")
 
-    # Iterate through each policy definition in the YAML
+    # Iterate through each policy definition in the YAML. Creates and updates are
+    # independent, so they are queued and sent in parallel once all are planned.
+    pending = []
     for policy_name, policy_data in policies_config.items():
         print(f"\n   -> Processing policy: '{policy_name}'")
 
@@ -128,24 +207,30 @@ def generate_and_apply_agent_policies(kibana_url: str, api_key: str, config: dic
                 continue
 
             fragment_path = fragments_dir / f"{fragment_filename}.json"
-            if not fragment_path.exists():
+            fragment_content = load_json_file(fragment_path)
+            if fragment_content is None:
                 print(f"      ⚠️  Warning: Fragment file '{fragment_path}' not found for definition '{def_key}'. Skipping.")
                 continue
-            
-            with open(fragment_path, 'r') as f:
-                fragment_content = json.load(f)
             desired_policy["package_policies"].append(fragment_content)
 
         # Idempotent Apply Logic
         if policy_name in policy_name_to_id:
             policy_id = policy_name_to_id[policy_name]
             print(f"      -> Plan: UPDATE existing policy (ID: {policy_id}).")
-            make_api_request("PUT", f"{kibana_url}/api/fleet/agent_policies/{policy_id}", api_key, json=desired_policy, dry_run=dry_run)
-            if not dry_run: print(f"      ✅ Updated.")
+            request = ("PUT", f"{kibana_url}/api/fleet/agent_policies/{policy_id}", desired_policy, f"      ✅ Updated '{policy_name}'.")
         else:
             print(f"      -> Plan: CREATE new policy.")
-            make_api_request("POST", f"{kibana_url}/api/fleet/agent_policies", api_key, json=desired_policy, dry_run=dry_run)
-            if not dry_run: print(f"      ✅ Created.")
+            request = ("POST", f"{kibana_url}/api/fleet/agent_policies", desired_policy, f"      ✅ Created '{policy_name}'.")
+
+        # Dry runs stay serial so each CURL command prints under its own policy.
+        if dry_run:
+            print_dry_run_request(*request[:2], json=desired_policy)
+        else:
+            pending.append(request)
+
+    if pending:
+        print(f"\n   -> Applying {len(pending)} agent policies...")
+    send_concurrently(pending, send)
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Build or update an Elastic deployment from an IaC state definition.")
@@ -172,7 +257,7 @@ def main() -> None:
     print(f"   Using state definition from '{state_dir}/'")
 
     with open(definition_file, 'r') as f:
-        config = yaml.safe_load(f)
+        config = yaml.load(f, Loader=YamlLoader)
 
     es_url = args.es_url
     if not es_url:
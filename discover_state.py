@@ -1,18 +1,39 @@
 #!/usr/bin/env python3
 import argparse
 import hashlib
-import json
 import os
 import pathlib
-import re
 import sys
+import threading
+import time
 from collections import defaultdict
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
-import requests
+import httpx
+import orjson
 import yaml
 
+from fleet_http import PRINT_LOCK, send_request
+
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+    print("⚠️  PyYAML was installed without libyaml; falling back to its much slower pure-Python emitter.", file=sys.stderr)
+
+# Opt-in (--cache) on-disk cache of GET responses, so repeated discovery runs
+# during development don't re-download unchanged state. None disables it.
+DEFAULT_CACHE_DIR = pathlib.Path(".fleet_cache")
+RESPONSE_CACHE_DIR: Optional[pathlib.Path] = None
+CACHE_TTL_SECONDS = 300
+
 # --- API Helper Functions ---
+def log(message: str) -> None:
+    """Prints a whole line at once; used by the discovery steps that run concurrently."""
+    with PRINT_LOCK:
+        print(message)
+
 def get_api_key() -> str:
     """Gets the API key from an environment variable and exits if not found."""
     api_key = os.getenv("ELASTIC_API_KEY")
@@ -20,20 +41,72 @@ def get_api_key() -> str:
         sys.exit("❌ ELASTIC_API_KEY environment variable is not set.")
     return api_key
 
+def read_cache_entry(cache_path: pathlib.Path) -> Optional[Dict]:
+    """Returns a cached response entry, or None if it is missing, unreadable or malformed."""
+    try:
+        entry = orjson.loads(cache_path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    if not isinstance(entry, dict) or not isinstance(entry.get("ts"), (int, float)) or "body" not in entry:
+        return None
+    return entry
+
+def write_cache_entry(cache_path: pathlib.Path, body: Dict, etag: Optional[str]) -> None:
+    """Atomically stores a response body and its ETag in the cache."""
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(f".{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(orjson.dumps({"ts": time.time(), "etag": etag, "body": body}))
+    os.replace(tmp_path, cache_path)
+
 def api_get(url: str, api_key: str, params: Optional[Dict] = None) -> Dict:
-    """Makes a GET request and handles errors."""
+    """
+    Makes a GET request and handles errors. Cached responses with an ETag are
+    always revalidated with If-None-Match; those without one are served from
+    the cache for CACHE_TTL_SECONDS and then fetched again in full.
+    """
+    global RESPONSE_CACHE_DIR
+    params = params or {}
     headers = {"Authorization": f"ApiKey {api_key}", "kbn-xsrf": "true"}
+    cache_path = None
+    cached = None
+    if RESPONSE_CACHE_DIR is not None:
+        key = hashlib.blake2b(f"{api_key}|{url}|{sorted(params.items())}".encode(), digest_size=16).hexdigest()
+        cache_path = RESPONSE_CACHE_DIR / f"{key}.json"
+        cached = read_cache_entry(cache_path)
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            elif time.time() - cached["ts"] < CACHE_TTL_SECONDS:
+                return cached["body"]
+
     try:
-        r = requests.get(url, headers=headers, params=params or {}, timeout=30)
-        r.raise_for_status()
-        return r.json()
-    except requests.exceptions.RequestException as exc:
+        r = send_request("GET", url, headers=headers, params=params)
+        if r.status_code == 304 and cached:
+            body = cached["body"]
+            etag = r.headers.get("ETag") or cached["etag"]
+        else:
+            r.raise_for_status()
+            body = orjson.loads(r.content)
+            etag = r.headers.get("ETag")
+    except (httpx.HTTPError, orjson.JSONDecodeError) as exc:
         sys.exit(f"❌ API error calling {url}: {exc}")
 
+    if cache_path is not None:
+        # The cache is only a development aid; failing to write it must not
+        # turn a successful fetch into an error. Warn once and stop caching.
+        try:
+            write_cache_entry(cache_path, body, etag)
+        except OSError as exc:
+            with PRINT_LOCK:
+                if RESPONSE_CACHE_DIR is not None:
+                    RESPONSE_CACHE_DIR = None
+                    print(f"⚠️  Could not write the response cache, continuing without it: {exc}")
+    return body
+
 # --- Asset Dumping Functions ---
 def dump_all_component_templates(es_url: str, api_key: str, out_dir: pathlib.Path) -> List[str]:
     """Fetches and saves all non-managed component templates."""
-    print("📂 Dumping component templates...")
+    log("📂 Dumping component templates...")
     comp_root = out_dir / "component_templates"
     comp_root.mkdir(parents=True, exist_ok=True)
     saved_files = []
@@ -46,18 +119,18 @@ def dump_all_component_templates(es_url: str, api_key: str, out_dir: pathlib.Pat
             if tpl.get("component_template", {}).get("_meta", {}).get("managed"):
                 continue
             output_path = comp_root / f"{tpl_name}.json"
-            with open(output_path, "w") as f:
-                json.dump(tpl["component_template"], f, indent=2)
+            with open(output_path, "wb") as f:
+                f.write(orjson.dumps(tpl["component_template"], option=orjson.OPT_INDENT_2))
             saved_files.append(tpl_name)
-        print(f"   -> Saved {len(saved_files)} non-managed component templates.")
+        log(f"   -> Saved {len(saved_files)} non-managed component templates.")
         return saved_files
     except Exception as e:
-        print(f"   -> ❌ Error querying component templates: {e}")
+        log(f"   -> ❌ Error querying component templates: {e}")
         return []
 
 def dump_all_ingest_pipelines(es_url: str, api_key: str, out_dir: pathlib.Path) -> List[str]:
     """Fetches and saves all non-managed ingest pipelines."""
-    print("📦 Dumping ingest pipelines...")
+    log("📦 Dumping ingest pipelines...")
     pipelines_dir = out_dir / "pipelines"
     pipelines_dir.mkdir(parents=True, exist_ok=True)
     saved_files = []
@@ -67,32 +140,50 @@ def dump_all_ingest_pipelines(es_url: str, api_key: str, out_dir: pathlib.Path)
             # Skip managed pipelines
             if pipeline.get("_meta", {}).get("managed"):
                 continue
-            with open(pipelines_dir / f"{name}.json", "w") as f:
-                json.dump(pipeline, f, indent=2)
+            with open(pipelines_dir / f"{name}.json", "wb") as f:
+                f.write(orjson.dumps(pipeline, option=orjson.OPT_INDENT_2))
             saved_files.append(name)
-        print(f"   -> Saved {len(saved_files)} non-managed ingest pipelines.")
+        log(f"   -> Saved {len(saved_files)} non-managed ingest pipelines.")
         return saved_files
     except Exception as e:
-        print(f"   -> ❌ Error querying ingest pipelines: {e}")
+        log(f"   -> ❌ Error querying ingest pipelines: {e}")
         return []
 
-def extract_and_save_integration_fragments(base_url: str, api_key: str, out_dir: pathlib.Path) -> Dict[str, Dict]:
+def iter_agent_policies(base_url: str, api_key: str, per_page: int = 500):
+    """
+    Yields every agent policy (with package policies), page by page. The next
+    page is fetched in the background while the caller processes the current one.
+    """
+    url = f"{base_url}/api/fleet/agent_policies"
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = 1
+        next_page = executor.submit(api_get, url, api_key, {"perPage": per_page, "page": page, "full": "true"})
+        while next_page is not None:
+            data = next_page.result() or {}
+            items = data.get("items", [])
+            next_page = None
+            if items and page * per_page < data.get("total", float("inf")):
+                page += 1
+                next_page = executor.submit(api_get, url, api_key, {"perPage": per_page, "page": page, "full": "true"})
+            yield from items
+
+def extract_and_save_integration_fragments(base_url: str, api_key: str, out_dir: pathlib.Path) -> Tuple[Dict[str, Dict], Dict[str, Optional[str]]]:
     """
     Fetches policies, saves clean integration fragments, and returns a map of
-    policy_id -> list of fragment file names.
+    policy_id -> list of fragment file names, plus a map of each saved
+    fragment file name -> the ingest pipeline it uses (or None).
     """
-    print("🧩 Processing policies and integrations into fragments...")
-    policies_data = api_get(f"{base_url}/api/fleet/agent_policies", api_key, {"perPage": 1000, "full": "true"})
+    log("🧩 Processing policies and integrations into fragments...")
     
     policy_to_fragments_map: Dict[str, Dict] = {}
     seen_hashes: Dict[str, str] = {}
+    fragment_pipelines: Dict[str, Optional[str]] = {}
     fname_counters = defaultdict(int)
+    pending_writes: List[tuple] = []
     frag_dir = out_dir / "integration_fragments"
     frag_dir.mkdir(exist_ok=True)
     
-    if not policies_data: return {}
-
-    for policy in policies_data.get("items", []):
+    for policy in iter_agent_policies(base_url, api_key):
         policy_id = policy["id"]
         policy_to_fragments_map[policy_id] = {"name": policy["name"], "description": policy["description"], "fragments": []}
 
@@ -103,7 +194,9 @@ def extract_and_save_integration_fragments(base_url: str, api_key: str, out_dir:
             clean_fragment = {key: pkg.get(key) for key in ['name', 'version', 'policy_template', 'vars'] if key in pkg}
             if 'vars' not in clean_fragment: clean_fragment['vars'] = {}
             
-            h = hashlib.sha256(json.dumps(clean_fragment, sort_keys=True).encode()).hexdigest()
+            # Key-sorted orjson bytes are a canonical form that hashes directly
+            canonical = orjson.dumps(clean_fragment, option=orjson.OPT_SORT_KEYS)
+            h = hashlib.blake2b(canonical, digest_size=16).hexdigest()
             if h in seen_hashes:
                 fragment_filename = seen_hashes[h]
             else:
@@ -116,32 +209,62 @@ def extract_and_save_integration_fragments(base_url: str, api_key: str, out_dir:
                 fname_counters[descriptive_name] += 1
                 fragment_filename = f"{descriptive_name}-{fname_counters[descriptive_name]}" if fname_counters[descriptive_name] > 1 else descriptive_name
                 
-                with open(frag_dir / f"{fragment_filename}.json", "w") as f:
-                    json.dump(clean_fragment, f, indent=2)
-                
+                pending_writes.append((frag_dir / f"{fragment_filename}.json", orjson.dumps(clean_fragment, option=orjson.OPT_INDENT_2)))
                 seen_hashes[h] = fragment_filename
+                fragment_pipelines[fragment_filename] = clean_fragment["vars"].get("pipeline")
             
             policy_to_fragments_map[policy_id]["fragments"].append(fragment_filename)
+
+    # Write all unique fragments in one batch, overlapping the per-file open
+    # and metadata latency, which dominates on slow or networked filesystems.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda write: write[0].write_bytes(write[1]), pending_writes))
     
-    print(f"   -> Created {len(seen_hashes)} unique integration fragments.")
-    return policy_to_fragments_map
+    log(f"   -> Created {len(seen_hashes)} unique integration fragments.")
+    return policy_to_fragments_map, fragment_pipelines
+
+def read_fragment_pipeline(path: str) -> Optional[str]:
+    """Returns a fragment's vars.pipeline, only decoding files that mention one."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if b'"pipeline"' not in data:
+        return None
+    return orjson.loads(data).get("vars", {}).get("pipeline")
 
-def build_integration_definitions(fragments_dir: pathlib.Path) -> Dict:
-    """Parses fragments to build the integration_definitions block."""
+def clean_definition_key(fragment_name: str) -> str:
+    """Makes a fragment name more readable, e.g., 'custom_logs-syslog_aci-1' -> 'syslog_aci'."""
+    # Plain string operations; this runs once per fragment and skips the regex engine
+    key = fragment_name.removeprefix("custom_logs-")
+    head, sep, tail = key.rpartition("-")
+    if sep and tail.isascii() and tail.isdigit():
+        key = head
+    return key
+
+def build_integration_definitions(fragments_dir: pathlib.Path, known_pipelines: Optional[Dict[str, Optional[str]]] = None) -> Dict:
+    """
+    Builds the integration_definitions block from the fragments directory.
+    Pipelines in known_pipelines (fragment name -> pipeline) are taken as-is;
+    only fragment files not listed there are read from disk.
+    """
     print("🔗 Analyzing fragments for pipeline dependencies...")
     definitions = {}
-    for frag_file in fragments_dir.glob("*.json"):
-        with open(frag_file, 'r') as f:
-            fragment_data = json.load(f)
-        
-        definition_key = frag_file.stem
-        # Make the key more readable, e.g., 'custom_logs-syslog_aci-1' -> 'syslog_aci'
-        clean_key = re.sub(r'^custom_logs-', '', definition_key)
-        clean_key = re.sub(r'-[0-9]+$', '', clean_key)
+    frag_pipelines = dict(known_pipelines or {})
+    # A single directory scan; the suffix and d_type checks need no per-entry stat
+    with os.scandir(fragments_dir) as entries:
+        frag_names = [entry.name[:-len(".json")] for entry in entries if entry.name.endswith(".json") and entry.is_file()]
+
+    # Only fragments not known in memory (e.g. left over from an earlier run)
+    # are read. Reading is I/O bound on a cold cache, so overlap the reads.
+    unread = [name for name in frag_names if name not in frag_pipelines]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        frag_pipelines.update(zip(unread, executor.map(read_fragment_pipeline, [str(fragments_dir / f"{name}.json") for name in unread])))
+
+    for definition_key in frag_names:
+        pipeline = frag_pipelines[definition_key]
+        clean_key = clean_definition_key(definition_key)
 
-        definitions[clean_key] = {"fragment": frag_file.stem}
+        definitions[clean_key] = {"fragment": definition_key}
         
-        pipeline = fragment_data.get("vars", {}).get("pipeline")
         if pipeline:
             definitions[clean_key]["dependencies"] = {"ingest_pipelines": [pipeline]}
     
@@ -153,32 +276,37 @@ def build_agent_policies_from_state(agents: List[Dict], policy_map: Dict, defini
     print("🧠 Analyzing state to build agent policies...")
     fragment_to_definition_key = {v['fragment']: k for k, v in definitions.items()}
 
-    # Group policies by their unique set of integration definitions
-    signature_to_policy = {}
-    for policy_id, policy_info in policy_map.items():
-        if not policy_info["fragments"]: continue
+    # Resolve and sort each policy's definition keys exactly once
+    policy_sorted_keys = {
+        pid: tuple(sorted(fragment_to_definition_key.get(f, f) for f in p_info["fragments"]))
+        for pid, p_info in policy_map.items() if p_info["fragments"]
+    }
 
-        definition_keys = sorted([fragment_to_definition_key.get(f, f) for f in policy_info["fragments"]])
-        signature = hashlib.sha256(" ".join(definition_keys).encode()).hexdigest()
+    # Group policies by their unique set of integration definitions, recording
+    # each policy's signature in the same pass. The hash is only used for
+    # deduplication, so a 128-bit BLAKE2 digest is plenty. Keys are joined with
+    # the ASCII unit separator rather than a space, which a key may contain.
+    signature_to_policy = {}
+    policy_id_to_signature = {}
+    for policy_id, definition_keys in policy_sorted_keys.items():
+        signature = hashlib.blake2b("\x1f".join(definition_keys).encode(), digest_size=16).hexdigest()
+        policy_id_to_signature[policy_id] = signature
 
         if signature not in signature_to_policy:
+            policy_info = policy_map[policy_id]
             signature_to_policy[signature] = {
                 "policy_name": policy_info["name"],
                 "policy_description": policy_info["description"],
-                "integrations": definition_keys,
-                "agents": [],
+                "integrations": list(definition_keys),
+                "agents": set(),
             }
-    
-    policy_id_to_signature = {
-        pid: hashlib.sha256(" ".join(sorted([fragment_to_definition_key.get(f, f) for f in p_info["fragments"]])).encode()).hexdigest()
-        for pid, p_info in policy_map.items() if p_info["fragments"]
-    }
 
     for agent in agents:
-        hostname = agent.get("local_metadata", {}).get("host", {}).get("hostname", agent.get("id"))
         signature = policy_id_to_signature.get(agent.get("policy_id"))
         if signature and signature in signature_to_policy:
-            signature_to_policy[signature]["agents"].append(hostname)
+            local_metadata = agent.get("local_metadata") or {}
+            hostname = (local_metadata.get("host") or {}).get("hostname") or agent.get("id")
+            signature_to_policy[signature]["agents"].add(hostname)
 
     final_policies = {}
     for sig_data in signature_to_policy.values():
@@ -188,17 +316,17 @@ def build_agent_policies_from_state(agents: List[Dict], policy_map: Dict, defini
             "integrations": sig_data["integrations"],
         }
         if sig_data["agents"]:
-            final_policies[policy_name]["_discovered_agents"] = sorted(list(set(sig_data["agents"])))
+            final_policies[policy_name]["_discovered_agents"] = sorted(sig_data["agents"])
 
     print(f"   -> Generated {len(final_policies)} agent policy definitions.")
     return final_policies
 
 
 def fetch_agents(base_url, api_key):
-    print("🕵️  Fetching enrolled agent list...")
+    log("🕵️  Fetching enrolled agent list...")
     agents_resp = api_get(f"{base_url}/api/fleet/agents", api_key, params={"perPage": 5000})
     agents = agents_resp.get("items", [])
-    print(f"   -> Found {len(agents)} agents.")
+    log(f"   -> Found {len(agents)} agents.")
     return agents
 
 
@@ -216,17 +344,22 @@ def generate_yaml(output_path: pathlib.Path, templates: List[str], pipelines: Li
     }
     
     with open(output_path, 'w') as f:
-        yaml.dump(final_structure, f, sort_keys=False, indent=2, default_flow_style=False)
+        yaml.dump(final_structure, f, Dumper=YamlDumper, sort_keys=False, indent=2, default_flow_style=False)
     
     print(f"   -> Successfully wrote state to {output_path}")
 
 def main():
+    global RESPONSE_CACHE_DIR
     parser = argparse.ArgumentParser(description="Discover and dump the state of an Elastic Fleet deployment into an IaC structure.")
     parser.add_argument("--url", required=True, help="The base URL of your Kibana instance.")
     parser.add_argument("--es-url", help="Optional: The base URL of your Elasticsearch instance. If not provided, it will be derived from the Kibana URL.")
     parser.add_argument("--output-dir", default="fleet_state_discovered", help="Directory to save the state files.")
+    parser.add_argument("--cache", action="store_true", help=f"Reuse API responses cached in '{DEFAULT_CACHE_DIR}/' by earlier runs (for development only).")
     args = parser.parse_args()
 
+    if args.cache:
+        RESPONSE_CACHE_DIR = DEFAULT_CACHE_DIR
+
     kibana_url = args.url.rstrip("/")
     api_key = get_api_key()
     out_dir = pathlib.Path(args.output_dir)
@@ -240,12 +373,19 @@ def main():
     
     print(f"🚀 Starting state discovery for {kibana_url}")
     
-    templates = dump_all_component_templates(es_url, api_key, out_dir)
-    pipelines = dump_all_ingest_pipelines(es_url, api_key, out_dir)
-    policy_map = extract_and_save_integration_fragments(kibana_url, api_key, out_dir)
+    # The four fetches hit independent endpoints, so run them side by side and
+    # wait for the slowest rather than the sum of all four.
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        templates_future = executor.submit(dump_all_component_templates, es_url, api_key, out_dir)
+        pipelines_future = executor.submit(dump_all_ingest_pipelines, es_url, api_key, out_dir)
+        fragments_future = executor.submit(extract_and_save_integration_fragments, kibana_url, api_key, out_dir)
+        agents_future = executor.submit(fetch_agents, kibana_url, api_key)
+        templates = templates_future.result()
+        pipelines = pipelines_future.result()
+        policy_map, fragment_pipelines = fragments_future.result()
+        agents = agents_future.result()
     
-    definitions = build_integration_definitions(out_dir / "integration_fragments")
-    agents = fetch_agents(kibana_url, api_key)
+    definitions = build_integration_definitions(out_dir / "integration_fragments", fragment_pipelines)
     policies = build_agent_policies_from_state(agents, policy_map, definitions)
     
     generate_yaml(out_dir / "fleet_definition.yaml", templates, pipelines, definitions, policies)
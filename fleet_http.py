@@ -0,0 +1,45 @@
+import atexit
+import threading
+import time
+
+import httpx
+
+# A single pooled HTTP/2 client. Concurrent requests to the same Kibana or
+# Elasticsearch host are multiplexed over one connection instead of each one
+# paying for its own TCP/TLS handshake. No explicit transport is passed, so
+# HTTP(S)_PROXY/NO_PROXY and SSL_CERT_FILE from the environment still apply.
+CLIENT = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+    timeout=30.0,
+    follow_redirects=True,
+)
+atexit.register(CLIENT.close)
+MAX_RETRIES = 3
+RETRY_STATUSES = {502, 503, 504}
+
+# Serialises progress output from worker threads so log lines never interleave.
+PRINT_LOCK = threading.Lock()
+
+def send_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Sends a request on the shared client with exponential backoff. Failed
+    connects are retried for every method, since nothing was sent. Read errors,
+    dropped connections and gateway errors are retried except for POST, which
+    is not idempotent.
+    """
+    idempotent = method.upper() != "POST"
+    for attempt in range(MAX_RETRIES + 1):
+        last_attempt = attempt == MAX_RETRIES
+        try:
+            response = CLIENT.request(method, url, **kwargs)
+        except httpx.ConnectError:
+            if last_attempt:
+                raise
+        except (httpx.ReadError, httpx.RemoteProtocolError):
+            if last_attempt or not idempotent:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or not idempotent or last_attempt:
+                return response
+        time.sleep(0.3 * 2 ** attempt)